@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import streamlit as st
-import re
 import random
+import time
 from collections import defaultdict
 
 # Orden objetivo de grupos (6 en total)
@@ -16,47 +16,47 @@ GROUP_ORDER = [
     "Comida 12",
 ]
 
-HEADER_RE = re.compile(r"^\s*-\s*(Comida|Cena)\s+(\d+)\s*$", re.IGNORECASE)
-
 # ===================== Parsing =====================
 
 def normalize_name(s: str) -> str:
-    s = s.strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    # split() sin argumentos ya recorta y colapsa cualquier racha de espacios
+    return " ".join(s.split())
 
 def parse_message(msg: str):
     """
     Devuelve:
       - todo_any: lista de nombres bajo 'TODO:' (pueden ir a cualquier grupo)
       - group_lists: dict[group_name] -> lista de nombres listados bajo ese encabezado
+      - groups: GROUP_ORDER más los encabezados nuevos que aparezcan (no modifica GROUP_ORDER)
     """
     lines = msg.splitlines()
     todo_section = False
     current_group = None
     todo_any = []
     group_lists = defaultdict(list)
+    groups = list(GROUP_ORDER)
 
     for raw in lines:
         line = raw.rstrip()
-        if not line.strip():
+        stripped = line.lstrip()
+        if not stripped:
             continue
 
-        # Inicio de TODO:
-        if re.match(r"^\s*TODO\s*:\s*$", line, flags=re.IGNORECASE):
+        # Inicio de TODO: (admite espacios antes de los dos puntos)
+        if stripped.endswith(":") and stripped[:-1].rstrip().lower() == "todo":
             todo_section = True
             current_group = None
             continue
 
-        # Encabezados tipo "- Comida 9"
-        m = HEADER_RE.match(line)
-        if m:
-            kind, num = m.group(1).capitalize(), m.group(2)
-            current_group = f"{kind} {num}"
-            todo_section = False
-            if current_group not in GROUP_ORDER:
-                GROUP_ORDER.append(current_group)  # por si añaden otro día
-            continue
+        # Encabezados tipo "- Comida 9": guion, tipo de comida y número de día
+        if stripped[:1] == "-":
+            parts = stripped[1:].split()
+            if len(parts) == 2 and parts[0].lower() in ("comida", "cena") and parts[1].isdecimal():
+                current_group = f"{parts[0].capitalize()} {parts[1]}"
+                todo_section = False
+                if current_group not in groups:
+                    groups.append(current_group)  # por si añaden otro día
+                continue
 
         # Línea de nombre
         name = normalize_name(line)
@@ -71,32 +71,41 @@ def parse_message(msg: str):
             # líneas sueltas fuera de secciones: ignoradas
             pass
 
-    return todo_any, group_lists
+    return todo_any, group_lists, groups
 
-def build_eligibilities(todo_any, group_lists):
+def build_eligibilities(todo_any, group_lists, groups):
     """
     Calcula los grupos permitidos por persona:
       - Los de TODO pueden ir a TODOS los grupos.
       - Los listados bajo encabezados solo a esos encabezados (si aparecen en varios, a cualquiera de esos).
+    Devuelve también 'imposibles': las personas que se han quedado sin ningún grupo.
     """
-    all_groups = list(GROUP_ORDER)
+    all_groups = list(groups)
     person_allowed = defaultdict(set)
+    # Solo alguien de TODO puede quedarse sin grupos (si no hay ninguno);
+    # se anota al crear su conjunto y se descarta si luego recibe alguno.
+    sin_grupos = {}
 
     for p in todo_any:
         if p:
             person_allowed[p].update(all_groups)
+            if not all_groups:
+                sin_grupos[p] = None
 
     for g, names in group_lists.items():
         for p in names:
             if p:
                 person_allowed[p].add(g)
+                if sin_grupos:
+                    sin_grupos.pop(p, None)
 
-    people = sorted(person_allowed.keys(), key=lambda s: s.lower())
-    return people, person_allowed, all_groups
+    people = sorted(person_allowed.keys(), key=str.lower)
+    imposibles = sorted(sin_grupos, key=str.lower)
+    return people, person_allowed, all_groups, imposibles
 
 # ===================== Lógica de asignación =====================
 
-def target_sizes(n_people, groups):
+def target_sizes(n_people, groups, dinner_mask=None):
     """
     Objetivos de tamaño por grupo priorizando que las CENAS queden
     con el tamaño más pequeño cuando no se pueda empatar todo.
@@ -105,14 +114,19 @@ def target_sizes(n_people, groups):
       - base = n // k para todos
       - reparte los 'rem' incrementos (+1) primero entre COMIDAS
         y solo si sobran, en CENAS.
+
+    dinner_mask (opcional) indica qué grupos son CENAS, para no recalcularlo.
     """
     k = len(groups)
     base = n_people // k
     rem = n_people % k
 
+    if dinner_mask is None:
+        dinner_mask = [g.lower().startswith("cena") for g in groups]
+
     targets = [base] * k
-    dinner_idx = [i for i, g in enumerate(groups) if g.lower().startswith("cena")]
-    lunch_idx  = [i for i in range(k) if i not in dinner_idx]
+    dinner_idx = [i for i in range(k) if dinner_mask[i]]
+    lunch_idx  = [i for i in range(k) if not dinner_mask[i]]
 
     i = 0
     while rem > 0 and i < len(lunch_idx):
@@ -127,78 +141,224 @@ def target_sizes(n_people, groups):
 
     return targets
 
-def asignar(people, allowed, groups, seed=None, max_intentos=2000):
+def asignar_backtracking(opciones, es_cena, objetivos, rng, max_nodos):
     """
-    Asignación ávida aleatoria balanceada:
+    Búsqueda exacta por backtracking (CSP):
+      - Variables: personas. Dominios: sus grupos permitidos.
+      - Restricción: ningún grupo supera su objetivo (así el reparto
+        cuadra exactamente con los objetivos).
+      - MRV: se asigna primero a la persona con menos grupos con hueco.
+      - LCV: se prueban antes los grupos más vacíos, COMIDAS antes que CENAS.
+
+    Trabaja con índices: opciones[i] es la tupla de grupos permitidos de la
+    persona i. Devuelve la lista con el grupo elegido por persona, o None si no
+    hay solución o si se agota el presupuesto de nodos.
+    """
+    tam = [0] * len(objetivos)
+    asign = [-1] * len(opciones)
+    nodos = 0
+
+    # Orden aleatorio (reproducible con la semilla) para desempatar
+    pendientes = list(range(len(opciones)))
+    rng.shuffle(pendientes)
+    azar = [rng.random() for _ in objetivos]
+
+    # Búsqueda en profundidad con pila explícita (sin recursión, para no
+    # chocar con el límite de recursión cuando hay muchas personas).
+    # Cada marco: [persona, posición en pendientes, grupos a probar, siguiente]
+    pila = []
+    while True:
+        if not pendientes:
+            return asign
+        nodos += 1
+        if nodos > max_nodos:
+            return None
+
+        # MRV: persona con menos grupos todavía disponibles
+        pos, libres = -1, None
+        for j, i in enumerate(pendientes):
+            cand = [gi for gi in opciones[i] if tam[gi] < objetivos[gi]]
+            if libres is None or len(cand) < len(libres):
+                pos, libres = j, cand
+                if not cand:
+                    break
+
+        if libres:
+            i = pendientes.pop(pos)
+            # LCV: grupos más vacíos primero; en empate, COMIDAS antes que CENAS
+            libres.sort(key=lambda gi: (tam[gi], es_cena[gi], azar[gi]))
+            pila.append([i, pos, libres, 0])
+
+        # Siguiente valor del marco superior; si no quedan, se deshace y se retrocede
+        while pila:
+            marco = pila[-1]
+            i, pos, libres, k = marco
+            if k > 0:
+                tam[libres[k - 1]] -= 1
+            if k < len(libres):
+                gi = libres[k]
+                tam[gi] += 1
+                asign[i] = gi
+                marco[3] = k + 1
+                break
+            pila.pop()
+            asign[i] = -1
+            pendientes.insert(pos, i)
+        else:
+            return None
+
+def asignar_avido(opciones, es_cena, objetivos, rng, max_intentos):
+    """
+    Asignación ávida aleatoria, repetida hasta max_intentos veces:
       1) Personas con menos opciones primero.
       2) Prefiere grupos por debajo de su objetivo.
       3) En empates, prefiere COMIDAS para mantener CENAS más pequeñas.
+
+    Se detiene antes si lleva 'paciencia' intentos seguidos sin mejorar.
+    Mismo formato de índices que asignar_backtracking. Devuelve el mejor
+    (asign, tam) encontrado, o None si alguien no tiene ningún grupo posible.
     """
-    rng = random.Random(seed)
-    n = len(people)
-    idx = {g: i for i, g in enumerate(groups)}
-    objetivos = target_sizes(n, groups)
+    n = len(opciones)
+    if not all(opciones):
+        return None  # ningún intento podría ser factible
 
     mejor = None
     mejor_score = float("inf")
-
-    base_order = sorted(people, key=lambda p: (len(allowed[p]), p.lower()))
+    paciencia = min(200, max_intentos // 4)
+    sin_mejora = 0
+
+    # Niveles de flexibilidad (no cambian entre intentos), de menos a más opciones
+    # (como mucho len(objetivos) opciones, así que basta una lista indexada por nivel)
+    buckets = [[] for _ in range(len(objetivos) + 1)]
+    for i in range(n):
+        buckets[len(opciones[i])].append(i)
+    bloques = [bloque for bloque in buckets if bloque]
+    randrange = rng.randrange
+
+    # Conjuntos de grupos como máscaras de bits (bit gi = grupo gi)
+    mascaras = [sum(1 << gi for gi in ops) for ops in opciones]
+    comidas = sum(1 << gi for gi in range(len(objetivos)) if not es_cena[gi])
+    con_hueco = sum(1 << gi for gi in range(len(objetivos)) if objetivos[gi] > 0)
+
+    # Reutilizados entre intentos: cada intento reescribe asign[i] para todas las personas
+    ceros = [0] * len(objetivos)
+    tam = ceros[:]
+    asign = [-1] * n
 
     for _ in range(max_intentos):
-        # Baraja dentro de cada nivel de flexibilidad
-        buckets = defaultdict(list)
-        for p in base_order:
-            buckets[len(allowed[p])].append(p)
-
+        # Baraja dentro de cada nivel de flexibilidad (Fisher-Yates en el sitio)
         orden = []
-        for k in sorted(buckets.keys()):
-            bloque = buckets[k][:]
-            rng.shuffle(bloque)
+        for bloque in bloques:
+            for j in range(len(bloque) - 1, 0, -1):
+                k = randrange(j + 1)
+                bloque[j], bloque[k] = bloque[k], bloque[j]
             orden.extend(bloque)
 
-        tam = [0] * len(groups)
-        asign = {}
-        factible = True
+        tam[:] = ceros
+        bajo_objetivo = con_hueco
 
-        for p in orden:
-            opciones = list(allowed[p])
-            if not opciones:
-                factible = False
-                break
+        for i in orden:
+            opciones_i = mascaras[i]
 
             # Primero grupos por debajo del objetivo
-            under = [g for g in opciones if tam[idx[g]] < objetivos[idx[g]]]
-            candidatos = under if under else opciones
+            candidatos = (opciones_i & bajo_objetivo) or opciones_i
 
             # Entre candidatos, los de menor tamaño actual
-            min_size = min(tam[idx[g]] for g in candidatos)
-            mejores = [g for g in candidatos if tam[idx[g]] == min_size]
+            min_size = n + 1
+            mejores = 0
+            while candidatos:
+                b = candidatos & -candidatos
+                t = tam[b.bit_length() - 1]
+                if t < min_size:
+                    min_size, mejores = t, b
+                elif t == min_size:
+                    mejores |= b
+                candidatos ^= b
 
             # Preferir COMIDAS si hay empate
-            lunch_best = [g for g in mejores if not g.lower().startswith("cena")]
-            if lunch_best:
-                mejores = lunch_best
-
-            elegido = rng.choice(mejores)
-            asign[p] = elegido
-            tam[idx[elegido]] += 1
-
-        if factible:
-            dev = sum(abs(tam[i] - objetivos[i]) for i in range(len(groups)))
-            spread = max(tam) - min(tam)
-            score = dev * 10 + spread
-            if score < mejor_score:
-                mejor_score = score
-                mejor = (asign, tam, objetivos)
-            if dev == 0 and spread <= 1:
-                return asign, tam, objetivos
-
-    if not mejor:
-        raise RuntimeError("No se pudo encontrar una asignación factible.")
+            mejores = (mejores & comidas) or mejores
+
+            # Uno al azar entre los bits activos (en orden de índice de grupo)
+            for _ in range(randrange(bin(mejores).count("1"))):
+                mejores &= mejores - 1
+            b = mejores & -mejores
+            elegido = b.bit_length() - 1
+            asign[i] = elegido
+            tam[elegido] += 1
+            if tam[elegido] == objetivos[elegido]:
+                bajo_objetivo &= ~b
+
+        # Desviación y rango en una sola pasada
+        dev = 0
+        mx = mn = tam[0]
+        for gi, t in enumerate(tam):
+            dev += abs(t - objetivos[gi])
+            if t > mx:
+                mx = t
+            elif t < mn:
+                mn = t
+        spread = mx - mn
+        score = dev * 10 + spread
+        if score < mejor_score:
+            mejor_score = score
+            mejor = (asign[:], tam[:])
+            sin_mejora = 0
+        else:
+            sin_mejora += 1
+        if dev == 0 and spread <= 1:
+            break
+        if sin_mejora > paciencia:
+            break  # ya ha convergido; más intentos no suelen mejorar
+
     return mejor
 
+def asignar(people, allowed, groups, seed=None, max_intentos=2000):
+    """
+    Asignación balanceada:
+      1) Primero intenta un reparto exacto por backtracking (ver asignar_backtracking).
+      2) Si no existe (o se agota la búsqueda), recurre a la asignación ávida
+         aleatoria (ver asignar_avido).
+
+    El presupuesto de nodos del backtracking es max_intentos + n: un reparto
+    sin retrocesos ya visita n + 1 nodos, así que con un presupuesto fijo la
+    búsqueda fallaría siempre cuando hay más personas que intentos.
+    """
+    rng = random.Random(seed)
+    n = len(people)
+    idx = {g: i for i, g in enumerate(groups)}
+    dinner_mask = tuple(g.lower().startswith("cena") for g in groups)
+    objetivos = target_sizes(n, groups, dinner_mask)
+
+    # Todo el cálculo se hace con índices: persona i = people[i], grupo gi = groups[gi]
+    allowed_idx = [tuple(sorted(idx[g] for g in allowed[p] if g in idx)) for p in people]
+
+    exacta = asignar_backtracking(allowed_idx, dinner_mask, objetivos, rng, max_intentos + n)
+    if exacta is not None:
+        asignacion = {people[i]: groups[gi] for i, gi in enumerate(exacta)}
+        return asignacion, list(objetivos), objetivos
+
+    resultado = asignar_avido(allowed_idx, dinner_mask, objetivos, rng, max_intentos)
+    if resultado is None:
+        raise RuntimeError("No se pudo encontrar una asignación factible.")
+    asign, tam = resultado
+    asignacion = {people[i]: groups[gi] for i, gi in enumerate(asign)}
+    return asignacion, tam, objetivos
+
 # ===================== Streamlit App =====================
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def parse_cached(text: str):
+    """
+    parse_message + build_eligibilities cacheados por texto de entrada, para que
+    las reejecuciones de Streamlit con el mismo texto no vuelvan a parsear.
+    La caché es compartida por todas las sesiones, así que se limita a 64 textos.
+    Devuelve estructuras serializables: (people, allowed con tuplas, all_groups, imposibles).
+    """
+    todo_any, group_lists, groups = parse_message(text)
+    people, person_allowed, all_groups, imposibles = build_eligibilities(todo_any, group_lists, groups)
+    allowed = {p: tuple(sorted(person_allowed[p])) for p in people}
+    return people, allowed, all_groups, imposibles
+
 def main():
     st.title("🍽️ Sorteo de Comidas")
     st.markdown("### Organiza automáticamente a las personas en grupos de comidas y cenas")
@@ -254,18 +414,17 @@ def main():
             
         try:
             # Procesamiento
-            todo_any, group_lists = parse_message(texto_input)
-            personas, allowed, _ = build_eligibilities(todo_any, group_lists)
+            # 'personas' ya viene ordenada alfabéticamente (build_eligibilities)
+            personas, allowed, todos_grupos, imposibles = parse_cached(texto_input)
             
             # Aseguramos exactamente los 6 grupos objetivo en orden
-            grupos = [g for g in GROUP_ORDER][:6]
+            grupos = todos_grupos[:6]
             
             if not personas:
                 st.error("❌ No se detectaron personas. Revisa el formato del texto.")
                 return
                 
             # Chequeo de personas sin opciones
-            imposibles = [p for p in personas if len(allowed[p]) == 0]
             if imposibles:
                 st.error(f"❌ Hay personas sin opciones de grupo: {', '.join(imposibles)}")
                 return
@@ -280,7 +439,6 @@ def main():
                     seed_type = "manual"
             else:
                 # Generar semilla automática basada en timestamp para reproducibilidad
-                import time
                 seed = int(time.time() * 1000) % 1000000  # Últimos 6 dígitos del timestamp
                 seed_type = "automática"
             
@@ -303,7 +461,7 @@ def main():
             with col1:
                 st.metric("Total personas", len(personas))
             with col2:
-                st.write(", ".join(sorted(personas, key=lambda s: s.lower())))
+                st.write(", ".join(personas))
             
             # Resumen de tamaños
             st.subheader("📊 Resumen de grupos")
@@ -321,16 +479,17 @@ def main():
             # Asignaciones por grupo
             st.subheader("🍽️ Asignaciones finales")
             
+            # Recorriendo 'personas' en orden, cada grupo queda ya ordenado
             por_grupo = defaultdict(list)
-            for persona, g in asignacion.items():
-                por_grupo[g].append(persona)
+            for persona in personas:
+                por_grupo[asignacion[persona]].append(persona)
             
             # Mostrar en columnas
             cols = st.columns(2)
             for i, grupo in enumerate(grupos):
                 with cols[i % 2]:
                     st.write(f"**{grupo}**")
-                    for nombre in sorted(por_grupo[grupo], key=lambda s: s.lower()):
+                    for nombre in por_grupo[grupo]:
                         st.write(f"• {nombre}")
                     st.write("")
             
@@ -347,30 +506,31 @@ def main():
             st.subheader("📋 Resultados para copiar")
             
             # Generar texto completo de resultados
-            resultado_texto = "🍽️ RESULTADOS DEL SORTEO DE COMIDAS\n"
-            resultado_texto += "=" * 50 + "\n"
-            resultado_texto += f"🌱 Semilla utilizada: {seed}\n"
-            resultado_texto += "=" * 50 + "\n\n"
+            partes = ["🍽️ RESULTADOS DEL SORTEO DE COMIDAS\n"]
+            partes.append("=" * 50 + "\n")
+            partes.append(f"🌱 Semilla utilizada: {seed}\n")
+            partes.append("=" * 50 + "\n\n")
             
-            resultado_texto += f"👥 PARTICIPANTES: {len(personas)} personas\n"
-            resultado_texto += f"Participantes: {', '.join(sorted(personas, key=lambda s: s.lower()))}\n\n"
+            partes.append(f"👥 PARTICIPANTES: {len(personas)} personas\n")
+            partes.append(f"Participantes: {', '.join(personas)}\n\n")
             
-            resultado_texto += "📊 RESUMEN DE GRUPOS:\n"
+            partes.append("📊 RESUMEN DE GRUPOS:\n")
             for grupo, size, objetivo in zip(grupos, tamanios, objetivos):
                 delta = size - objetivo
                 delta_str = f" ({delta:+d})" if delta != 0 else " (✓)"
-                resultado_texto += f"• {grupo}: {size} personas{delta_str}\n"
-            resultado_texto += "\n"
+                partes.append(f"• {grupo}: {size} personas{delta_str}\n")
+            partes.append("\n")
             
-            resultado_texto += "🍽️ ASIGNACIONES FINALES:\n"
-            resultado_texto += "-" * 30 + "\n"
+            partes.append("🍽️ ASIGNACIONES FINALES:\n")
+            partes.append("-" * 30 + "\n")
             for grupo in grupos:
-                resultado_texto += f"\n{grupo.upper()}:\n"
-                for nombre in sorted(por_grupo[grupo], key=lambda s: s.lower()):
-                    resultado_texto += f"  • {nombre}\n"
+                partes.append(f"\n{grupo.upper()}:\n")
+                for nombre in por_grupo[grupo]:
+                    partes.append(f"  • {nombre}\n")
             
-            resultado_texto += "\n" + "=" * 50 + "\n"
-            resultado_texto += f"📈 Estadísticas: Desviación={desviacion}, Diferencia máx={diferencia_max}"
+            partes.append("\n" + "=" * 50 + "\n")
+            partes.append(f"📈 Estadísticas: Desviación={desviacion}, Diferencia máx={diferencia_max}")
+            resultado_texto = "".join(partes)
             
             # Mostrar el texto en un área de texto copiable
             st.info("💡 **Instrucciones para móvil:** Mantén presionado sobre el texto de abajo, selecciona todo y copia.")